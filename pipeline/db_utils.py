@@ -1,13 +1,53 @@
 from __future__ import annotations
 
+import re
+import shutil
+import sys
 from dataclasses import dataclass
+from functools import lru_cache
+from typing import TYPE_CHECKING
 
 import pandas as pd
 from sqlalchemy import create_engine, text
+from sqlalchemy.dialects.mssql import DATETIME2
 from sqlalchemy.engine import Engine
+from sqlalchemy.types import REAL, TypeEngine
 
+if TYPE_CHECKING:
+    from bcpandas import SqlCreds
 
-@dataclass
+# Số dòng mỗi batch khi bulk-copy bằng bcp
+BCP_BATCH_SIZE = 50_000
+
+# Tên bảng không truyền được dưới dạng tham số trong SQL Server: ghép bằng QUOTENAME
+# phía server rồi chạy qua sp_executesql. Text câu lệnh không đổi giữa các bảng/tháng
+# nên SQL Server dùng lại plan đã cache thay vì parse/compile lại mỗi lần.
+_DROP_TABLE_SQL = text(
+    """
+    IF OBJECT_ID(N'dbo.' + QUOTENAME(:tbl), 'U') IS NOT NULL
+    BEGIN
+        DECLARE @sql NVARCHAR(MAX) = N'DROP TABLE [dbo].' + QUOTENAME(:tbl);
+        EXEC sp_executesql @sql;
+    END
+    """
+)
+
+_DELETE_MONTH_SQL = text(
+    """
+    IF OBJECT_ID(N'dbo.' + QUOTENAME(:tbl), 'U') IS NOT NULL
+    BEGIN
+        DECLARE @sql NVARCHAR(MAX) =
+            N'DELETE FROM [dbo].' + QUOTENAME(:tbl) + N' WHERE id_month = @m';
+        EXEC sp_executesql @sql, N'@m INT', @m = :m;
+    END
+    """
+)
+
+# Số dòng mỗi lần executemany khi ghi bằng df.to_sql (fallback khi không có bcp)
+TO_SQL_CHUNKSIZE = 10_000
+
+
+@dataclass(frozen=True)
 class DBConfig:
     server: str
     port: int
@@ -32,10 +72,70 @@ class DBConfig:
             params += "&TrustServerCertificate=yes"
         return f"{base}?{params}"
 
+    @property
+    def driver_version(self) -> int:
+        """
+        Phiên bản ODBC driver, ví dụ "ODBC Driver 18 for SQL Server" -> 18.
+        """
+        m = re.search(r"\d+", self.driver)
+        return int(m.group()) if m else 17
+
+    @property
+    def supports_bcp(self) -> bool:
+        """
+        bcpandas không truyền cờ -u (trust server certificate) cho bcp, mà từ
+        ODBC Driver 18 kết nối mặc định được mã hoá và kiểm tra chứng chỉ.
+        Trên Linux/macOS, make_bcp_creds truyền Encrypt=no để bcpandas thêm -Yo
+        (mã hoá tuỳ chọn, không kiểm tra chứng chỉ) nên bcp vẫn chạy được.
+        Trên Windows bcpandas không thêm cờ -Y nào: khi cần TrustServerCertificate
+        với driver >= 18 (vd. SQL Server local dùng chứng chỉ tự ký), bcp sẽ lỗi
+        xác thực chứng chỉ -> không dùng bcp.
+        """
+        return not (
+            sys.platform == "win32"
+            and self.trust_server_certificate
+            and self.driver_version >= 18
+        )
 
+    def make_bcp_creds(self, database: str) -> "SqlCreds":
+        """
+        Tạo SqlCreds của bcpandas cho một database cụ thể (dùng cho bulk-copy).
+        """
+        from bcpandas import SqlCreds
+
+        odbc_kwargs = None
+        if self.trust_server_certificate:
+            # Encrypt=no -> bcpandas thêm -Yo cho bcp (ngoài Windows) để bỏ qua
+            # bước kiểm tra chứng chỉ; engine của SqlCreds vẫn trust chứng chỉ.
+            odbc_kwargs = {"Encrypt": "no", "TrustServerCertificate": "yes"}
+        return SqlCreds(
+            server=self.server,
+            database=database,
+            username=self.username,
+            password=self.password,
+            driver_version=self.driver_version,
+            port=self.port,
+            odbc_kwargs=odbc_kwargs,
+        )
+
+
+def bcp_available() -> bool:
+    """
+    Kiểm tra có thể bulk-copy bằng bcp hay không:
+    cần cả thư viện bcpandas và tiện ích bcp trên PATH.
+    """
+    try:
+        import bcpandas  # noqa: F401
+    except ImportError:
+        return False
+    return shutil.which("bcp") is not None
+
+
+@lru_cache(maxsize=None)
 def _get_master_engine(cfg: DBConfig) -> Engine:
     """
     Engine kết nối tới database 'master' để có thể tạo DB mới.
+    Được cache theo cfg: mỗi process chỉ tạo một lần.
     """
     url = cfg.make_url("master")
     # Dùng AUTOCOMMIT để có thể chạy CREATE DATABASE ngoài transaction
@@ -46,13 +146,12 @@ def _get_master_engine(cfg: DBConfig) -> Engine:
     )
 
 
-def get_or_create_engine_for_year(year: int, cfg: DBConfig) -> Engine:
+def ensure_database_for_year(year: int, cfg: DBConfig) -> None:
     """
-    Đảm bảo tồn tại database Data_<year>, sau đó trả về Engine kết nối vào DB đó.
+    Đảm bảo tồn tại database Data_<year> (idempotent).
     """
     db_name = f"Data_{year}"
 
-    # 1) Tạo DB nếu chưa có
     master_engine = _get_master_engine(cfg)
     # CREATE DATABASE không được nằm trong multi-statement transaction,
     # nên ta chạy bằng AUTOCOMMIT và không dùng transaction context.
@@ -60,9 +159,55 @@ def get_or_create_engine_for_year(year: int, cfg: DBConfig) -> Engine:
     with master_engine.connect() as conn:
         conn.execute(text(create_sql))
 
-    # 2) Engine trỏ vào DB Data_<year>
-    data_engine = create_engine(cfg.make_url(db_name), fast_executemany=True)
-    return data_engine
+
+@lru_cache(maxsize=None)
+def get_engine_for_year(year: int, cfg: DBConfig) -> Engine:
+    """
+    Engine kết nối vào database Data_<year> (DB phải tồn tại sẵn,
+    xem ensure_database_for_year). Được cache theo (year, cfg) để các lần ghi
+    trong cùng process dùng lại engine/connection pool thay vì tạo mới.
+    """
+    return create_engine(cfg.make_url(f"Data_{year}"), fast_executemany=True)
+
+
+def get_or_create_engine_for_year(year: int, cfg: DBConfig) -> Engine:
+    """
+    Đảm bảo tồn tại database Data_<year>, sau đó trả về Engine kết nối vào DB đó.
+    """
+    ensure_database_for_year(year, cfg)
+    return get_engine_for_year(year, cfg)
+
+
+def sql_dtypes_for(df: pd.DataFrame) -> dict[str, TypeEngine]:
+    """
+    Ánh xạ kiểu cột pandas -> kiểu cột SQL Server khi tạo bảng.
+    Mặc định pandas tạo FLOAT (8 byte) cho mọi cột số thực; cột float32
+    được tạo là REAL (4 byte) để bảng nhỏ bằng một nửa. Cột thời gian (không
+    timezone) được tạo là DATETIME2. Kiểu cố định cũng giúp pyodbc bind tham số
+    ổn định giữa các chunk.
+    """
+    dtypes: dict[str, TypeEngine] = {}
+    for col, dtype in df.dtypes.items():
+        if dtype == "float32":
+            dtypes[str(col)] = REAL()
+        elif pd.api.types.is_datetime64_dtype(dtype):
+            dtypes[str(col)] = DATETIME2()
+    return dtypes
+
+
+def create_training_table(engine: Engine, schema: pd.DataFrame, table_name: str) -> None:
+    """
+    Tạo bảng training theo schema (DataFrame rỗng: cột + dtype) nếu chưa có.
+    Gọi một lần trước khi các worker ghi song song vào cùng bảng, để không có
+    hai process cùng thấy bảng chưa tồn tại rồi cùng CREATE TABLE.
+    """
+    schema.head(0).to_sql(
+        name=table_name,
+        con=engine,
+        if_exists="append",  # bảng đã có thì không làm gì
+        index=False,
+        dtype=sql_dtypes_for(schema),
+    )
 
 
 def write_training_table(
@@ -71,6 +216,7 @@ def write_training_table(
     table_name: str,
     *,
     replace_if_exists: bool = True,
+    db_config: DBConfig | None = None,
 ) -> None:
     """
     Ghi DataFrame training (92 cột) vào bảng SQL Server.
@@ -78,51 +224,64 @@ def write_training_table(
     - Nếu replace_if_exists=True: sẽ DROP bảng cũ (nếu có) trước khi ghi lại.
       Điều này giúp pipeline idempotent cho cùng (year, month, region).
     - Nếu replace_if_exists=False: dùng if_exists='append'.
+
+    Nếu truyền db_config, máy có bcp và cấu hình kết nối dùng được với bcp
+    (xem DBConfig.supports_bcp), dữ liệu được bulk-copy bằng bcpandas
+    (nhanh hơn nhiều so với INSERT qua ODBC). Ngược lại dùng df.to_sql qua engine.
     """
     if df.empty:
         return
 
-    if replace_if_exists:
-        drop_stmt = text(
-            "IF OBJECT_ID(:tbl, 'U') IS NOT NULL "
-            "BEGIN DROP TABLE [dbo]." + table_name + " END"
+    if db_config is not None and db_config.supports_bcp and bcp_available():
+        import bcpandas
+
+        creds = db_config.make_bcp_creds(engine.url.database)
+        bcpandas.to_sql(
+            df,
+            table_name,
+            creds,
+            index=False,
+            if_exists="replace" if replace_if_exists else "append",
+            # bcpandas từ chối batch_size lớn hơn số dòng của df
+            batch_size=min(BCP_BATCH_SIZE, len(df)),
+            dtype=sql_dtypes_for(df),
         )
+        return
+
+    if replace_if_exists:
         with engine.begin() as conn:
-            conn.execute(drop_stmt, {"tbl": table_name})
+            conn.execute(_DROP_TABLE_SQL, {"tbl": table_name})
         if_exists_mode = "fail"  # sau khi drop, bảng chưa tồn tại
     else:
         if_exists_mode = "append"
 
-    # Chia chunksize để tránh lỗi giới hạn tham số
-    chunksize = max(10, 2000 // max(1, len(df.columns)))
-
+    # Không dùng method="multi" (một câu INSERT ... VALUES khổng lồ mỗi chunk):
+    # để mặc định executemany, kết hợp fast_executemany=True trên engine
+    # thì pyodbc bind cả mảng tham số một lần.
     df.to_sql(
         name=table_name,
         con=engine,
         if_exists=if_exists_mode,
         index=False,
-        chunksize=chunksize,
-        method="multi",
+        chunksize=TO_SQL_CHUNKSIZE,
+        dtype=sql_dtypes_for(df),
     )
 
 
-def delete_month_partition(engine: Engine, table_name: str, id_month: int) -> None:
+def delete_month_partitions(engine: Engine, table_names: list[str], id_month: int) -> None:
     """
-    Xoá dữ liệu của một tháng (id_month) trong bảng partition theo cột id_month,
-    nếu bảng đã tồn tại. Dùng để đảm bảo idempotent trên (year, month, region):
+    Xoá dữ liệu của một tháng (id_month) trong các bảng partition theo cột id_month,
+    với bảng nào đã tồn tại. Dùng để đảm bảo idempotent trên (year, month, region):
     chạy lại cùng năm/tháng sẽ thay data tháng đó thay vì append trùng.
+    Mọi bảng được xoá trong cùng một transaction/connection (một lần commit).
     """
-    # Không dùng tham số cho tên bảng trong SQL Server, nên chèn trực tiếp table_name
-    # (table_name được code sinh ra, không phải input từ user).
-    sql = text(
-        f"""
-        IF OBJECT_ID(:tbl, 'U') IS NOT NULL
-        BEGIN
-            DELETE FROM [dbo].{table_name} WHERE id_month = :m
-        END
-        """
-    )
     with engine.begin() as conn:
-        conn.execute(sql, {"tbl": table_name, "m": id_month})
+        for table_name in table_names:
+            conn.execute(_DELETE_MONTH_SQL, {"tbl": table_name, "m": id_month})
 
 
+def delete_month_partition(engine: Engine, table_name: str, id_month: int) -> None:
+    """
+    Xoá dữ liệu của một tháng (id_month) trong một bảng, xem delete_month_partitions.
+    """
+    delete_month_partitions(engine, [table_name], id_month)
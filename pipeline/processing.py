@@ -5,6 +5,7 @@ from typing import Dict, Tuple
 
 import numpy as np
 import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
 
 import Source.utils_1 as utils_1
 
@@ -22,9 +23,34 @@ BAY_LAT_MAX = 38.2
 BAY_LON_MIN = -123.0
 BAY_LON_MAX = -121.8
 
+# Khung (lat_min, lat_max, lon_min, lon_max) của từng vùng
+REGION_BOUNDS: Dict[str, Tuple[float, float, float, float]] = {
+    "offshore": (OFFSHORE_LAT_MIN, OFFSHORE_LAT_MAX, OFFSHORE_LON_MIN, OFFSHORE_LON_MAX),
+    "bay": (BAY_LAT_MIN, BAY_LAT_MAX, BAY_LON_MIN, BAY_LON_MAX),
+}
+
 # Giới hạn số lượng tàu giống notebook: chỉ lấy top 350 MMSI mỗi vùng
 TOP_MMSI_PER_REGION = 350
 
+# Hệ số lượng tử hoá int16 cho các feature có miền giá trị bị chặn
+# (giá trị lưu = round(x * scale)): SOG trong [0, 40] -> 0.01 knot,
+# sin/cos trong [-1, 1] -> 1e-4. X_norm/Y_norm không bị chặn nên giữ float32.
+QUANT_SCALES: Dict[str, float] = {
+    "SOG": 100.0,
+    "Heading_sin": 10_000.0,
+    "Heading_cos": 10_000.0,
+    "COG_sin": 10_000.0,
+    "COG_cos": 10_000.0,
+    "hour_sin": 10_000.0,
+    "hour_cos": 10_000.0,
+}
+
+# Độ dài window (số bước đầu vào) của dataset training
+SEQ_LEN = 10
+
+# Số mẫu sliding window tối đa mỗi vùng (tương đương 100 shard x 270_000 mẫu trước đây)
+MAX_SAMPLES_PER_REGION = 100 * 270_000
+
 
 def split_regions_by_lat(df: pd.DataFrame) -> Dict[str, pd.DataFrame]:
     """
@@ -35,30 +61,55 @@ def split_regions_by_lat(df: pd.DataFrame) -> Dict[str, pd.DataFrame]:
     if "LAT" not in df.columns or "LON" not in df.columns:
         raise ValueError("DataFrame phải có cả cột 'LAT' và 'LON' để tách vùng.")
 
-    df = df.copy()
+    # Tính một mảng mã vùng (0 = ngoài vùng, 1 = offshore, 2 = bay) trực tiếp
+    # trên ndarray LAT/LON, tránh copy DataFrame và các Series trung gian.
+    lat = df["LAT"].to_numpy()
+    lon = df["LON"].to_numpy()
 
-    mask_offshore = (
-        (df["LAT"] >= OFFSHORE_LAT_MIN)
-        & (df["LAT"] <= OFFSHORE_LAT_MAX)
-        & (df["LON"] >= OFFSHORE_LON_MIN)
-        & (df["LON"] <= OFFSHORE_LON_MAX)
+    code = np.zeros(len(df), dtype=np.uint8)
+    np.putmask(
+        code,
+        (lat >= OFFSHORE_LAT_MIN)
+        & (lat <= OFFSHORE_LAT_MAX)
+        & (lon >= OFFSHORE_LON_MIN)
+        & (lon <= OFFSHORE_LON_MAX),
+        1,
     )
-    mask_bay = (
-        (df["LAT"] >= BAY_LAT_MIN)
-        & (df["LAT"] <= BAY_LAT_MAX)
-        & (df["LON"] >= BAY_LON_MIN)
-        & (df["LON"] <= BAY_LON_MAX)
+    np.putmask(
+        code,
+        (lat >= BAY_LAT_MIN)
+        & (lat <= BAY_LAT_MAX)
+        & (lon >= BAY_LON_MIN)
+        & (lon <= BAY_LON_MAX),
+        2,
     )
 
-    df_offshore = df[mask_offshore]
-    df_bay = df[mask_bay]
-
     return {
-        "offshore": df_offshore.reset_index(drop=True),
-        "bay": df_bay.reset_index(drop=True),
+        "offshore": df.take(np.flatnonzero(code == 1)).reset_index(drop=True),
+        "bay": df.take(np.flatnonzero(code == 2)).reset_index(drop=True),
     }
 
 
+def select_top_mmsi(df: pd.DataFrame, k: int = TOP_MMSI_PER_REGION) -> pd.DataFrame:
+    """
+    Chỉ giữ lại các dòng thuộc k MMSI có nhiều bản ghi nhất.
+    """
+    # np.unique + argpartition (chọn một phần, O(U)) thay cho groupby + sort toàn bộ,
+    # kiểm tra thuộc tập top bằng searchsorted trên mảng đã sort thay cho isin.
+    # Bỏ MMSI null như groupby (np.unique gộp NaN thành một nhóm, null của ArrowDtype lỗi khi so sánh)
+    mmsi = df["MMSI"]
+    df = df[mmsi.notna()]
+    mmsi = df["MMSI"].to_numpy()
+    uniq, counts = np.unique(mmsi, return_counts=True)
+    k = min(k, len(uniq))
+    if k <= 0:
+        return df.iloc[:0]
+
+    top = np.sort(uniq[np.argpartition(counts, -k)[-k:]])
+    pos = np.minimum(np.searchsorted(top, mmsi), len(top) - 1)
+    return df.take(np.flatnonzero(top[pos] == mmsi))
+
+
 def _basic_cleaning(df: pd.DataFrame) -> pd.DataFrame:
     """
     Cleaning tối thiểu để tương thích với logic trong notebook:
@@ -66,7 +117,7 @@ def _basic_cleaning(df: pd.DataFrame) -> pd.DataFrame:
     - lọc SOG trong khoảng [6, 40]
     - sort theo (MMSI, BaseDateTime)
     Khoảng cách thời gian (delta_t) và các kiểm soát window sẽ
-    được xử lý bên trong utils_1.build_sequence_samples_limited.
+    được xử lý bên trong build_sequence_samples (xem _window_points).
     """
     required_cols = [
         "BaseDateTime",
@@ -81,25 +132,281 @@ def _basic_cleaning(df: pd.DataFrame) -> pd.DataFrame:
     if missing:
         raise ValueError(f"Thiếu các cột bắt buộc trong raw data: {missing}")
 
-    dfc = df.copy()
-    dfc["BaseDateTime"] = pd.to_datetime(dfc["BaseDateTime"], errors="coerce")
-    dfc = dfc.dropna(subset=required_cols)
+    # Không deep-copy df: tính một mask duy nhất rồi lấy các dòng hợp lệ
+    # trực tiếp từ ndarray của từng cột (một lần cấp phát, một lần sort).
+    bdt = df["BaseDateTime"]
+    if not pd.api.types.is_datetime64_any_dtype(bdt):
+        # Format cố định của log NOAA (YYYY-MM-DDTHH:MM:SS): parse bằng nhánh ISO8601
+        # thay vì đoán format từng phần tử. Dữ liệu đọc từ parquet thường đã là
+        # timestamp nên bước này bị bỏ qua.
+        bdt = pd.to_datetime(bdt, format="ISO8601", errors="coerce", cache=True)
+    sog = df["SOG"].to_numpy(dtype=np.float64, na_value=np.nan)
+
+    mask = (
+        bdt.notna().to_numpy()
+        & df[required_cols[1:]].notna().all(axis=1).to_numpy()
+        # Lọc tốc độ như trong thiết kế: 6–40
+        & (sog >= 6.0)
+        & (sog <= 40.0)
+    )
+    idx = np.flatnonzero(mask)
+
+    # Lấy dòng trước rồi mới to_numpy: với cột pd.ArrowDtype (không còn null)
+    # sẽ ra ndarray đúng kiểu thay vì mảng object.
+    data = {"BaseDateTime": bdt.iloc[idx].to_numpy()}
+    for col in required_cols[1:]:
+        data[col] = df[col].iloc[idx].to_numpy()
+
+    return pd.DataFrame(data).sort_values(
+        ["MMSI", "BaseDateTime"], kind="stable", ignore_index=True
+    )
+
+
+def _window_points(
+    df: pd.DataFrame,
+    *,
+    stop_speed: float,
+    max_sog: float,
+    min_time_gap: float,
+    max_time_gap: float,
+    mmsi_col: str = "MMSI",
+    time_col: str = "BaseDateTime",
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Chọn các điểm dùng để cắt window (thời gian hợp lệ, stop_speed < SOG <= max_sog)
+    trên df đã sort theo (mmsi_col, time_col).
+
+    Trả về:
+    - idx_keep: vị trí (iloc) các điểm được giữ
+    - gap_ok: gap_ok[k] = True nếu khoảng thời gian từ điểm k-1 tới điểm k
+      (trong idx_keep) nằm trong (min_time_gap, max_time_gap] và cùng MMSI
+    """
+    t = pd.to_datetime(df[time_col], errors="coerce")
+    sog = df["SOG"].to_numpy(dtype=np.float64)
+    keep = t.notna().to_numpy() & (sog > float(stop_speed)) & (sog <= float(max_sog))
+    idx_keep = np.flatnonzero(keep)
+
+    n = len(idx_keep)
+    mmsi = df[mmsi_col].to_numpy()[idx_keep]
+    t_sec = t.to_numpy(dtype="datetime64[ns]")[idx_keep].astype(np.int64) / 1e9
+
+    # dt[k] = khoảng thời gian từ điểm k-1 tới điểm k; đầu mỗi MMSI = inf
+    # nên mọi cửa sổ vắt qua 2 MMSI đều bị loại bởi điều kiện max_time_gap.
+    dt = np.empty(n, dtype=np.float64)
+    if n:
+        dt[0] = np.inf
+        np.subtract(t_sec[1:], t_sec[:-1], out=dt[1:])
+        dt[1:][mmsi[1:] != mmsi[:-1]] = np.inf
+    gap_ok = (dt > float(min_time_gap)) & (dt <= float(max_time_gap))
+    return idx_keep, gap_ok
+
+
+def has_any_window(
+    df: pd.DataFrame,
+    *,
+    seq_len: int = SEQ_LEN,
+    stop_speed: float = 6.0,
+    max_sog: float = 40.0,
+    min_time_gap: float = 1.0,
+    max_time_gap: float = 300.0,
+    mmsi_col: str = "MMSI",
+    time_col: str = "BaseDateTime",
+) -> bool:
+    """
+    Kiểm tra nhanh (trước khi tạo feature) xem df đã cleaning + sort có thể
+    cho ra ít nhất một window seq_len bước hay không: cần một chuỗi seq_len
+    khoảng thời gian hợp lệ liên tiếp trong cùng một MMSI (seq_len + 1 điểm).
+    """
+    _, gap_ok = _window_points(
+        df,
+        stop_speed=stop_speed,
+        max_sog=max_sog,
+        min_time_gap=min_time_gap,
+        max_time_gap=max_time_gap,
+        mmsi_col=mmsi_col,
+        time_col=time_col,
+    )
+    if len(gap_ok) < seq_len + 1:
+        return False
+
+    # Độ dài chuỗi True dài nhất trong gap_ok
+    edges = np.diff(np.concatenate(([0], gap_ok.view(np.int8), [0])))
+    run_lengths = np.flatnonzero(edges == -1) - np.flatnonzero(edges == 1)
+    return bool(run_lengths.size) and int(run_lengths.max()) >= seq_len
+
+
+def training_schema(
+    feature_cols: list[str],
+    target_cols: list[str],
+    *,
+    seq_len: int = SEQ_LEN,
+    quantize: bool = False,
+) -> pd.DataFrame:
+    """
+    DataFrame rỗng có đúng cột + dtype của output build_sequence_samples:
+    feature *_t0..*_t{L-1} rồi target; float32, hoặc int16 cho các feature
+    trong QUANT_SCALES khi quantize=True.
+    """
+    data: Dict[str, np.ndarray] = {}
+    for t in range(seq_len):
+        for col in feature_cols:
+            dtype = np.int16 if quantize and col in QUANT_SCALES else np.float32
+            data[f"{col}_t{t}"] = np.empty(0, dtype=dtype)
+    for col in target_cols:
+        data[col] = np.empty(0, dtype=np.float32)
+    return pd.DataFrame(data)
+
 
-    # Lọc tốc độ như trong thiết kế: 6–40
-    dfc = dfc[(dfc["SOG"] >= 6.0) & (dfc["SOG"] <= 40.0)]
+def empty_training_frame(quantize: bool = False) -> pd.DataFrame:
+    """
+    Schema (DataFrame rỗng) của dataset training 92 cột do
+    build_training_dataset_for_region tạo ra, dùng để tạo sẵn bảng SQL.
+    """
+    return training_schema(
+        utils_1.FEATURE_INPUT, utils_1.TARGET, seq_len=SEQ_LEN, quantize=quantize
+    )
+
+
+def build_sequence_samples(
+    df_feat: pd.DataFrame,
+    feature_cols: list[str],
+    target_cols: list[str],
+    *,
+    seq_len: int = SEQ_LEN,
+    stop_speed: float = 6.0,
+    max_sog: float = 40.0,
+    min_time_gap: float = 1.0,
+    max_time_gap: float = 300.0,
+    max_samples: int = MAX_SAMPLES_PER_REGION,
+    mmsi_col: str = "MMSI",
+    time_col: str = "BaseDateTime",
+    quantize: bool = False,
+) -> pd.DataFrame:
+    """
+    Bản vectorized của utils_1.build_sequence_samples_limited (stride=1),
+    cho ra đúng các mẫu (t0..t{L-1} -> tL) theo cùng thứ tự:
+    - chỉ giữ điểm có stop_speed < SOG <= max_sog
+    - mọi khoảng thời gian trong cửa sổ (kể cả tới điểm target) nằm trong
+      (min_time_gap, max_time_gap], không vượt qua ranh giới MMSI
+    - feature và target đều hữu hạn
+    - tối đa max_samples mẫu
+
+    Cửa sổ được lấy bằng np.lib.stride_tricks.sliding_window_view (view, không copy)
+    trên toàn bộ vùng thay vì vòng lặp Python theo từng dòng.
+    df_feat phải đã sort theo (mmsi_col, time_col), như output của
+    utils_1.build_phase_features.
+
+    Nếu quantize=True: các feature có trong QUANT_SCALES được lượng tử hoá
+    sang int16 trước khi nhân bản theo window (cột SQL kiểu SMALLINT, nhỏ bằng
+    một nửa REAL); đọc lại bằng dequantize_window_features.
+    """
+    feature_names = [f"{col}_t{t}" for t in range(seq_len) for col in feature_cols]
+    out_cols = feature_names + list(target_cols)
+
+    idx_keep, gap_ok = _window_points(
+        df_feat,
+        stop_speed=stop_speed,
+        max_sog=max_sog,
+        min_time_gap=min_time_gap,
+        max_time_gap=max_time_gap,
+        mmsi_col=mmsi_col,
+        time_col=time_col,
+    )
+
+    n = len(idx_keep)
+    if n < seq_len + 1:
+        return training_schema(feature_cols, target_cols, seq_len=seq_len, quantize=quantize)
+
+    X = df_feat[feature_cols].to_numpy(dtype=np.float32)[idx_keep]
+    Y = df_feat[list(target_cols)].to_numpy(dtype=np.float32)[idx_keep]
+
+    # Cửa sổ bắt đầu tại i dùng feature các dòng i..i+L-1, target dòng i+L,
+    # và các khoảng dt[i+1..i+L].
+    n_win = n - seq_len
+    valid = sliding_window_view(gap_ok[1:], seq_len).all(axis=1)
+    row_finite = np.isfinite(X).all(axis=1)
+    valid &= sliding_window_view(row_finite[:-1], seq_len).all(axis=1)
+    valid &= np.isfinite(Y[seq_len:]).all(axis=1)
+
+    starts = np.flatnonzero(valid[:n_win])[:max_samples]
+    if len(starts) == 0:
+        return training_schema(feature_cols, target_cols, seq_len=seq_len, quantize=quantize)
+
+    if not quantize:
+        out = np.empty((len(starts), seq_len * X.shape[1] + len(target_cols)), dtype=np.float32)
+        _take_windows(X, starts, seq_len, out)
+        np.take(Y, starts + seq_len, axis=0, out=out[:, out.shape[1] - len(target_cols) :])
+        return pd.DataFrame(out, columns=out_cols, copy=False)
 
-    dfc = dfc.sort_values(["MMSI", "BaseDateTime"])
-    return dfc.reset_index(drop=True)
+    q_pos = [k for k, col in enumerate(feature_cols) if col in QUANT_SCALES]
+    f_pos = [k for k, col in enumerate(feature_cols) if col not in QUANT_SCALES]
+
+    # Lượng tử hoá trước khi cắt window; dòng không hữu hạn không thuộc window hợp lệ nào.
+    scales = np.array([QUANT_SCALES[feature_cols[k]] for k in q_pos], dtype=np.float32)
+    Xq = X[:, q_pos]
+    Xq = np.rint(np.where(np.isfinite(Xq), Xq, 0.0) * scales).astype(np.int16)
+
+    out_q = np.empty((len(starts), seq_len * len(q_pos)), dtype=np.int16)
+    _take_windows(Xq, starts, seq_len, out_q)
+    out_f = np.empty((len(starts), seq_len * len(f_pos) + len(target_cols)), dtype=np.float32)
+    _take_windows(X[:, f_pos], starts, seq_len, out_f)
+    np.take(Y, starts + seq_len, axis=0, out=out_f[:, out_f.shape[1] - len(target_cols) :])
+
+    # Ghép lại theo đúng thứ tự cột *_t0..*_t{L-1} + target
+    data: Dict[str, np.ndarray] = {}
+    for t in range(seq_len):
+        for k, col in enumerate(feature_cols):
+            name = f"{col}_t{t}"
+            if col in QUANT_SCALES:
+                data[name] = out_q[:, t * len(q_pos) + q_pos.index(k)]
+            else:
+                data[name] = out_f[:, t * len(f_pos) + f_pos.index(k)]
+    for j, col in enumerate(target_cols):
+        data[col] = out_f[:, seq_len * len(f_pos) + j]
+    return pd.DataFrame(data)
+
+
+def _take_windows(X: np.ndarray, starts: np.ndarray, seq_len: int, out: np.ndarray) -> None:
+    """
+    Ghi các window X[i : i + seq_len] (i thuộc starts), trải phẳng theo từng bước,
+    vào out[:, :seq_len * F] — lấy qua sliding_window_view, không tạo mảng tạm.
+    """
+    n_feat = X.shape[1]
+    nf = seq_len * n_feat
+    windows = sliding_window_view(X, (seq_len, n_feat))[:, 0]  # (n - L + 1, L, F)
+    np.take(windows, starts, axis=0, out=out[:, :nf].reshape(len(starts), seq_len, n_feat))
+
+
+def dequantize_window_features(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Đổi các cột feature đã lượng tử hoá int16 (build_sequence_samples(quantize=True),
+    kiểu SMALLINT trong SQL) về float32 theo QUANT_SCALES. Sửa tại chỗ và trả về df.
+    Chỉ dùng cho bảng chứa toàn dữ liệu lượng tử hoá (run_pipeline ghi vào bảng
+    training_<region>_q riêng): cột số thực được coi là chưa lượng tử hoá.
+    """
+    for col in df.columns:
+        base = str(col).rsplit("_t", 1)[0]
+        if base in QUANT_SCALES and pd.api.types.is_integer_dtype(df[col]):
+            df[col] = (df[col].to_numpy(dtype=np.float32) / np.float32(QUANT_SCALES[base]))
+    return df
 
 
 def build_training_dataset_for_region(
     df_region: pd.DataFrame,
+    *,
+    top_mmsi: int | None = TOP_MMSI_PER_REGION,
+    quantize: bool = False,
 ) -> Tuple[pd.DataFrame, dict]:
     """
     Xây dựng dataset huấn luyện (92 cột) cho một vùng (bay/offshore):
     - Cleaning cơ bản
     - Gọi utils_1.build_phase_features để tạo feature + scaler riêng
-    - Gọi utils_1.build_sequence_samples_limited để cắt sliding window 10 bước
+    - Gọi build_sequence_samples để cắt sliding window 10 bước
+
+    Nếu top_mmsi=None: bỏ qua bước chọn top MMSI (df_region đã được chọn sẵn,
+    ví dụ bằng truy vấn DuckDB trong run_pipeline.load_region_subset).
+    Nếu quantize=True: các feature bị chặn (SOG, sin/cos) được lưu int16,
+    hệ số nằm trong meta["quant_scales"] (xem build_sequence_samples).
 
     Trả về:
     - df_train: DataFrame có 92 cột (90 feature + 2 target)
@@ -110,16 +417,19 @@ def build_training_dataset_for_region(
 
     # Giữ nguyên logic chọn top 350 MMSI giống các notebook:
     # tính theo dữ liệu đã lọc thô (SOG>3, vùng lat) trước khi cleaning sâu.
-    counts = (
-        df_region.groupby("MMSI")
-        .size()
-        .sort_values(ascending=False)
-    )
-    top_mmsi = counts.head(TOP_MMSI_PER_REGION).index
-    df_region = df_region[df_region["MMSI"].isin(top_mmsi)]
+    if top_mmsi is not None:
+        df_region = select_top_mmsi(df_region, top_mmsi)
 
     df_clean = _basic_cleaning(df_region)
 
+    # Điều kiện cắt window, dùng chung cho bước kiểm tra sớm và bước cắt thật
+    window_params = dict(seq_len=SEQ_LEN, stop_speed=6.0, max_sog=40.0, max_time_gap=300.0)
+
+    # Không MMSI nào đủ điểm liên tiếp cho một window -> bỏ qua vùng,
+    # không tốn công tạo feature / fit scaler.
+    if not has_any_window(df_clean, **window_params):
+        return pd.DataFrame(columns=[]), {}
+
     # Tạo feature + chuẩn hóa XY cho riêng vùng này (scaler riêng)
     df_feat, meta = utils_1.build_phase_features(
         df_clean,
@@ -130,26 +440,20 @@ def build_training_dataset_for_region(
         scaler_xy=None,
     )
 
-    # Cắt sliding window theo đúng hàm trong utils_1
-    shards = utils_1.build_sequence_samples_limited(
+    # Cắt sliding window 10 bước (cùng điều kiện với utils_1.build_sequence_samples_limited)
+    df_train = build_sequence_samples(
         df_feat,
         feature_cols=utils_1.FEATURE_INPUT,
-        seq_len=10,
-        stop_speed=6.0,
-        max_time_gap=300.0,
-        mmsi_col="MMSI",
-        time_col="BaseDateTime",
-        target_cols=tuple(utils_1.TARGET),  # type: ignore[arg-type]
-        stride=1,
-        max_sog=40.0,
-        max_samples_per_group=270_000,
-        max_total_groups=100,
+        target_cols=utils_1.TARGET,
+        quantize=quantize,
+        **window_params,
     )
+    if quantize:
+        meta["quant_scales"] = dict(QUANT_SCALES)
 
-    if not shards:
+    if df_train.empty:
         return pd.DataFrame(columns=[]), meta
 
-    df_train = pd.concat(shards, ignore_index=True)
     return df_train, meta
 
 
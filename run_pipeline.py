@@ -1,25 +1,31 @@
 from __future__ import annotations
 
+import os
+import queue
 import re
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
-from typing import Iterable
+from typing import Any, Callable, Iterable, NamedTuple
 
 import duckdb
+import numpy as np
 import pandas as pd
 
 from pipeline.processing import (
-    split_regions_by_lat,
     build_training_dataset_for_region,
-    OFFSHORE_LAT_MIN,
-    OFFSHORE_LAT_MAX,
-    BAY_LAT_MIN,
-    BAY_LAT_MAX,
+    empty_training_frame,
+    REGION_BOUNDS,
+    TOP_MMSI_PER_REGION,
 )
 from pipeline.db_utils import (
     DBConfig,
-    get_or_create_engine_for_year,
+    create_training_table,
+    ensure_database_for_year,
+    get_engine_for_year,
     write_training_table,
-    delete_month_partition,
+    delete_month_partitions,
 )
 
 
@@ -28,6 +34,10 @@ RAW_DATA_DIR = Path("raw_data")
 
 # Cấu hình kết nối SQL Server.
 # TODO: sửa username/password/server cho đúng môi trường của bạn.
+# Ghi bảng bằng bcp (nếu có bcpandas + bcp trên PATH): trên Linux/macOS chạy được
+# với cấu hình dưới đây (bcp được gọi với -Yo). Trên Windows, bcp chỉ dùng được khi
+# server có chứng chỉ tin cậy (trust_server_certificate=False) hoặc driver < 18;
+# ngược lại pipeline tự chuyển sang df.to_sql (chậm hơn).
 DB_CONFIG = DBConfig(
     server="localhost",
     port=1433,
@@ -38,21 +48,54 @@ DB_CONFIG = DBConfig(
 )
 
 
+# Số process xử lý file song song. None: tự chọn min(số file, cpu_count // 2).
+# Mỗi worker còn giữ DataFrame vùng/feature/window riêng ngoài DuckDB,
+# nên đặt nhỏ lại khi máy ít RAM (hoặc truyền main(max_workers=...)).
+MAX_WORKERS: int | None = None
+
+# Số thread DuckDB cho mỗi process worker (tránh oversubscription khi chạy song song nhiều file)
+DUCKDB_THREADS_PER_WORKER = 4
+# Tổng RAM dành cho DuckDB của cả pipeline (MB), chia đều cho các worker
+DUCKDB_MEMORY_BUDGET_MB = 8 * 1024
+
+# Kết nối DuckDB dùng chung trong process (tạo một lần, xem _init_duckdb)
+_DDB: duckdb.DuckDBPyConnection | None = None
+
+# Lượng tử hoá các feature bị chặn (SOG, sin/cos) sang int16/SMALLINT trước khi cắt window.
+# Giảm kích thước bảng training nhưng đổi schema nên được ghi vào bảng riêng
+# training_<region>_q (không trộn với bảng REAL training_<region>);
+# bên đọc phải gọi pipeline.processing.dequantize_window_features. Tắt mặc định.
+QUANTIZE_WINDOW_FEATURES = False
+
+# Số phần tử tối đa trong mỗi hàng đợi giữa các stage (giới hạn RAM đỉnh)
+PIPELINE_QUEUE_SIZE = 2
+
 FILE_PATTERN = re.compile(r"^(?P<year>\d{4})_NOAA_AIS_logs_(?P<month>\d{2})\.parquet$")
 
 
-def discover_raw_files(directory: Path) -> list[Path]:
+class RawFile(NamedTuple):
+    """File raw .parquet kèm (year, month) đã parse từ tên file."""
+
+    path: Path
+    year: int
+    month: int
+
+
+def discover_raw_files(directory: Path) -> list[RawFile]:
     """
     Tìm tất cả file .parquet hợp lệ trong thư mục raw_data.
     Chỉ nhận những file đúng pattern YYYY_NOAA_AIS_logs_MM.parquet.
+    Regex chỉ chạy một lần cho mỗi file: trả về luôn (path, year, month).
     """
     if not directory.exists():
         return []
 
     files = []
-    for p in directory.glob("*.parquet"):
-        if FILE_PATTERN.match(p.name):
-            files.append(p)
+    for p in directory.iterdir():
+        if not p.name.endswith(".parquet"):
+            continue
+        if m := FILE_PATTERN.match(p.name):
+            files.append(RawFile(p, int(m["year"]), int(m["month"])))
     return sorted(files)
 
 
@@ -67,122 +110,301 @@ def parse_year_month_from_name(filename: str) -> tuple[int, int]:
     return year, month
 
 
-def load_raw_subset(path: Path) -> pd.DataFrame:
+def to_raw_file(path: Path) -> RawFile:
+    """
+    Parse (year, month) từ tên file do người dùng truyền vào.
+    """
+    year, month = parse_year_month_from_name(path.name)
+    return RawFile(path, year, month)
+
+
+def training_table_name(region_name: str) -> str:
+    """
+    Tên bảng training của một vùng trong DB Data_<year> (không encode tháng trong tên bảng).
+    Dữ liệu lượng tử hoá (QUANTIZE_WINDOW_FEATURES) dùng bảng riêng hậu tố _q vì
+    kiểu cột khác (SMALLINT thay vì REAL).
+    """
+    suffix = "_q" if QUANTIZE_WINDOW_FEATURES else ""
+    return f"training_{region_name}{suffix}"
+
+
+def _init_duckdb(memory_limit_mb: int = DUCKDB_MEMORY_BUDGET_MB) -> None:
     """
-    Đọc file parquet lớn bằng DuckDB và chỉ lấy subset cần dùng
+    Tạo kết nối DuckDB dùng chung cho process hiện tại (cấu hình thread/RAM một lần,
+    bật cache metadata parquet để các truy vấn cùng file dùng lại footer đã đọc).
+    Dùng làm initializer cho mỗi worker của ProcessPoolExecutor, với memory_limit_mb
+    là phần của worker đó trong DUCKDB_MEMORY_BUDGET_MB.
+    """
+    global _DDB
+    _DDB = duckdb.connect(
+        config={
+            "threads": DUCKDB_THREADS_PER_WORKER,
+            "memory_limit": f"{memory_limit_mb}MB",
+        }
+    )
+    _DDB.execute("SET parquet_metadata_cache = true")
+
+
+def _duckdb_cursor() -> duckdb.DuckDBPyConnection:
+    """
+    Cursor trên kết nối DuckDB dùng chung (mỗi thread nên dùng cursor riêng).
+    """
+    if _DDB is None:
+        _init_duckdb()
+    assert _DDB is not None
+    return _DDB.cursor()
+
+
+def load_region_subset(path: Path, region_name: str) -> pd.DataFrame:
+    """
+    Đọc file parquet lớn bằng DuckDB và chỉ lấy dữ liệu của một vùng
     để tránh tràn RAM:
     - Chỉ các cột cần thiết cho pipeline
-    - Chỉ 2 dải LAT: offshore + bay
+    - Chỉ các điểm nằm trong khung LAT/LON của vùng
     - Lọc thêm SOG > 3, góc hợp lệ (0–360)
+    - Chỉ giữ top TOP_MMSI_PER_REGION MMSI có nhiều bản ghi nhất trong vùng
+    - SOG/COG/Heading ép về REAL (float32), MMSI về UINTEGER để giảm RAM;
+      LAT/LON giữ DOUBLE vì phép chiếu XY cần độ chính xác cỡ mét
+    Toàn bộ việc lọc + xếp hạng MMSI chạy trong DuckDB (đa luồng),
+    pandas chỉ nhận kết quả cuối.
     """
-    con = duckdb.connect()
+    lat_min, lat_max, lon_min, lon_max = REGION_BOUNDS[region_name]
+
+    con = _duckdb_cursor()
 
     query = f"""
-    SELECT
-        BaseDateTime,
-        LAT,
-        LON,
-        SOG,
-        COG,
-        Heading,
-        MMSI
-    FROM '{path.as_posix()}'
-    WHERE
-        SOG > 3
-        AND COG >= 0 AND COG < 360
-        AND Heading >= 0 AND Heading < 360
-        AND (
-            (LAT BETWEEN {OFFSHORE_LAT_MIN} AND {OFFSHORE_LAT_MAX})
-            OR
-            (LAT BETWEEN {BAY_LAT_MIN} AND {BAY_LAT_MAX})
-        )
+    WITH filt AS (
+        SELECT
+            BaseDateTime,
+            LAT,
+            LON,
+            CAST(SOG AS REAL) AS SOG,
+            CAST(COG AS REAL) AS COG,
+            CAST(Heading AS REAL) AS Heading,
+            CAST(MMSI AS UINTEGER) AS MMSI
+        FROM '{path.as_posix()}'
+        WHERE
+            SOG > 3
+            AND COG >= 0 AND COG < 360
+            AND Heading >= 0 AND Heading < 360
+            AND LAT BETWEEN {lat_min} AND {lat_max}
+            AND LON BETWEEN {lon_min} AND {lon_max}
+    ),
+    top_mmsi AS (
+        SELECT MMSI, COUNT(*) AS n
+        FROM filt
+        WHERE MMSI IS NOT NULL
+        GROUP BY MMSI
+        QUALIFY ROW_NUMBER() OVER (ORDER BY n DESC, MMSI) <= {TOP_MMSI_PER_REGION}
+    )
+    SELECT f.*
+    FROM filt f
+    JOIN top_mmsi USING (MMSI)
     """
-    df = con.execute(query).df()
+    # Nhận kết quả dạng Arrow rồi bọc bằng pd.ArrowDtype: không copy cột số sang
+    # block NumPy; self_destruct giải phóng buffer Arrow ngay khi pandas nhận.
+    table = con.execute(query).arrow()
     con.close()
+    df = table.to_pandas(types_mapper=pd.ArrowDtype, self_destruct=True, split_blocks=True)
+    del table
     return df
 
 
-def process_single_file(path: Path, db_config: DBConfig) -> None:
+def _run_stage(
+    fn: Callable[[Any], Any],
+    q_in: queue.Queue,
+    q_out: queue.Queue | None,
+    errors: list[BaseException],
+) -> None:
+    """
+    Vòng lặp của một stage trong pipeline producer-consumer:
+    lấy item từ q_in, xử lý bằng fn, đẩy kết quả (khác None) sang q_out.
+    Dừng khi gặp sentinel None và chuyển tiếp sentinel cho stage sau.
+    Khi đã có lỗi ở bất kỳ stage nào, chỉ xả hàng đợi để các thread khác không bị treo.
+    """
+    while True:
+        item = q_in.get()
+        if item is None:
+            break
+        if errors:
+            continue
+        try:
+            out = fn(item)
+        except BaseException as exc:
+            errors.append(exc)
+            continue
+        if q_out is not None and out is not None:
+            q_out.put(out)
+    if q_out is not None:
+        q_out.put(None)
+
+
+def process_single_file(raw_file: RawFile, db_config: DBConfig) -> None:
     """
     Xử lý một file raw .parquet:
-    - đọc dữ liệu
-    - tách bay/offshore
+    - đọc dữ liệu của từng vùng bay/offshore (đã lọc top MMSI trong DuckDB)
     - feature engineering + sliding window (92 cột)
-    - ghi vào đúng database + bảng theo năm/tháng/vùng.
+    - ghi vào đúng database + bảng theo năm/tháng/vùng
+      (database Data_<year> phải tồn tại sẵn, main() tạo trước bằng
+      ensure_database_for_year).
+
+    Ba bước chạy trên 3 thread nối nhau bằng hàng đợi có giới hạn
+    (load -> transform -> write), nên việc đọc/ghi của vùng này chồng lấn
+    với xử lý của vùng kia và RAM chỉ giữ tối đa vài vùng cùng lúc
+    thay vì toàn bộ dữ liệu tháng.
     """
-    year, month = parse_year_month_from_name(path.name)
+    path, year, month = raw_file
     print(f"\n=== Processing file: {path.name} (year={year}, month={month}) ===")
 
-    # 1) Load raw parquet (subset để tránh tràn RAM)
-    print("  - Loading raw parquet (filtered subset via DuckDB)...")
-    df_raw = load_raw_subset(path)
-    print(f"    Raw shape: {df_raw.shape}")
-
-    # 2) Split thành 2 vùng: bay / offshore
-    regions = split_regions_by_lat(df_raw)
-
-    for region_name, df_region in regions.items():
-        if df_region.empty:
-            print(f"  - Region {region_name}: empty, skip.")
-            continue
-
+    # Database Data_<year> đã được tạo sẵn trong main()
+    engine = get_engine_for_year(year, db_config)
+    cleared = False
+
+    def clear_month() -> None:
+        # Idempotent theo tháng: xoá dữ liệu cũ của tháng này ở mọi bảng vùng
+        # (một transaction cho cả file), kể cả vùng không còn dữ liệu.
+        # Chỉ chạy ngay trước lần ghi đầu tiên (hoặc sau khi đọc/xử lý xong
+        # nếu không có gì để ghi), để lỗi ở bước đọc/xử lý không làm mất dữ liệu cũ.
+        nonlocal cleared
+        if not cleared:
+            delete_month_partitions(
+                engine, [training_table_name(region_name) for region_name in REGION_BOUNDS], month
+            )
+            cleared = True
+
+    q_raw: queue.Queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    q_out: queue.Queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    errors: list[BaseException] = []
+
+    def produce() -> None:
+        try:
+            for region_name in REGION_BOUNDS:
+                if errors:
+                    break
+                # 1) + 2) Load subset của vùng từ parquet (lọc + top MMSI trong DuckDB)
+                print(f"  - Region {region_name}: loading filtered subset via DuckDB...")
+                try:
+                    df_region = load_region_subset(path, region_name)
+                except BaseException as exc:
+                    errors.append(exc)
+                    break
+                if df_region.empty:
+                    print(f"  - Region {region_name}: empty, skip.")
+                    continue
+                q_raw.put((region_name, df_region))
+        finally:
+            q_raw.put(None)
+
+    def transform(item: tuple[str, pd.DataFrame]) -> tuple[str, pd.DataFrame]:
+        region_name, df_region = item
         print(f"  - Region {region_name}: input rows = {len(df_region)}")
 
         # 3) Xử lý đặc trưng + sliding window để ra dataset 92 cột
-        df_train, meta = build_training_dataset_for_region(df_region)
-        print(f"    -> Training dataset shape: {df_train.shape}")
+        df_train, meta = build_training_dataset_for_region(
+            df_region, top_mmsi=None, quantize=QUANTIZE_WINDOW_FEATURES
+        )
+        print(f"    -> [{region_name}] Training dataset shape: {df_train.shape}")
+        return region_name, df_train
+
+    def load(item: tuple[str, pd.DataFrame]) -> None:
+        region_name, df_train = item
 
         # 4) Ghi vào SQL Server
         # Thiết kế: mỗi DB năm có 2 bảng cố định:
         #   - training_offshore
         #   - training_bay
+        # (hoặc training_<region>_q khi lượng tử hoá)
         # và thêm cột id_month để phân biệt tháng.
-        engine = get_or_create_engine_for_year(year, db_config)
-
-        table_name = f"training_{region_name}"  # không encode tháng trong tên bảng
+        table_name = training_table_name(region_name)
 
-        # Gắn thêm cột id_month để truy vấn theo tháng sau này
-        df_to_write = df_train.copy()
-        df_to_write["id_month"] = month
-
-        # Idempotent theo tháng: xoá dữ liệu cũ của tháng này rồi ghi lại
-        delete_month_partition(engine, table_name, month)
+        # Gắn thêm cột id_month để truy vấn theo tháng sau này: thêm tại chỗ
+        # (một block int16 mới, không copy các cột feature), df_train không dùng lại sau bước ghi.
+        df_train["id_month"] = np.int16(month)
 
         print(f"    -> Writing to table: {table_name} (id_month={month}) in DB Data_{year}")
 
+        clear_month()
         write_training_table(
-            df=df_to_write,
+            df=df_train,
             engine=engine,
             table_name=table_name,
             replace_if_exists=False,  # append các tháng khác, tháng này đã xoá trước
+            db_config=db_config,  # bulk-copy bằng bcp nếu có
         )
 
+    threads = [
+        threading.Thread(target=produce, name="load"),
+        threading.Thread(target=_run_stage, args=(transform, q_raw, q_out, errors), name="transform"),
+        threading.Thread(target=_run_stage, args=(load, q_out, None, errors), name="write"),
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    if errors:
+        raise errors[0]
+
+    # Không vùng nào có dữ liệu để ghi: vẫn xoá dữ liệu cũ của tháng
+    clear_month()
+
     print(f"=== Done file: {path.name} ===")
 
 
-def main(files: Iterable[Path] | None = None) -> None:
+def main(files: Iterable[Path] | None = None, max_workers: int | None = None) -> None:
     """
     Điểm vào chính của pipeline.
     - Nếu `files` None: tự động quét folder raw_data.
-    - Nếu truyền list file cụ thể: chỉ xử lý các file đó.
+    - Nếu truyền list file cụ thể: chỉ xử lý các file đó
+      (tên file phải đúng pattern YYYY_NOAA_AIS_logs_MM.parquet).
+    - `max_workers`: số process song song, mặc định theo MAX_WORKERS.
     """
     RAW_DATA_DIR.mkdir(parents=True, exist_ok=True)
 
     if files is None:
         files_to_process = discover_raw_files(RAW_DATA_DIR)
     else:
-        files_to_process = list(files)
+        files_to_process = [to_raw_file(p) for p in files]
 
     if not files_to_process:
         print(f"Không tìm thấy file .parquet nào trong {RAW_DATA_DIR.resolve()}")
         return
 
     print("Sẽ xử lý các file sau:")
-    for p in files_to_process:
-        print(f"  - {p.name}")
-
-    for p in files_to_process:
-        process_single_file(p, DB_CONFIG)
+    for f in files_to_process:
+        print(f"  - {f.path.name}")
+
+    # Tạo trước các database Data_<year> và các bảng vùng một lần cho cả pipeline:
+    # các tháng cùng năm ghi song song vào cùng bảng, nên không để từng worker
+    # tự tạo bảng (hai worker có thể cùng CREATE TABLE trên DB mới).
+    schema = empty_training_frame(quantize=QUANTIZE_WINDOW_FEATURES)
+    schema["id_month"] = pd.Series(dtype=np.int16)
+    for year in sorted({f.year for f in files_to_process}):
+        ensure_database_for_year(year, DB_CONFIG)
+        engine = get_engine_for_year(year, DB_CONFIG)
+        for region_name in REGION_BOUNDS:
+            create_training_table(engine, schema, training_table_name(region_name))
+        # Không để các worker (fork) kế thừa connection đang mở của process cha
+        engine.dispose()
+
+    # Mỗi file ghi một partition id_month riêng (bảng đã tạo sẵn ở trên) -> xử lý
+    # song song nhiều file, mỗi process tự tạo engine/kết nối DuckDB riêng.
+    if max_workers is None:
+        max_workers = MAX_WORKERS
+    if max_workers is None:
+        max_workers = (os.cpu_count() or 2) // 2
+    max_workers = max(1, min(len(files_to_process), max_workers))
+
+    # Chia ngân sách RAM DuckDB cho các worker thay vì mỗi worker một giới hạn đầy đủ
+    memory_limit_mb = max(256, DUCKDB_MEMORY_BUDGET_MB // max_workers)
+    print(f"Chạy {max_workers} worker, DuckDB memory_limit={memory_limit_mb}MB/worker")
+
+    with ProcessPoolExecutor(
+        max_workers=max_workers,
+        initializer=_init_duckdb,
+        initargs=(memory_limit_mb,),
+    ) as ex:
+        list(ex.map(partial(process_single_file, db_config=DB_CONFIG), files_to_process))
 
     print("\nHoàn thành toàn bộ pipeline.")
 